@@ -10,10 +10,8 @@ from pathlib import Path
 from datetime import datetime
 import streamlit as st
 import joblib
-import shap
-from sklearn.inspection import PartialDependenceDisplay
-import matplotlib.pyplot as plt
-from fpdf import FPDF
+# shap, plotly i fpdf s'importen dins les funcions/branques que els fan servir:
+# només calen després d'una predicció i així la primera càrrega de la pàgina és més ràpida
 
 # --- CONFIGURACIÓ DE PATHS ---
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -21,6 +19,8 @@ DATA_PATH = BASE_DIR / "data" / "raw" / "cancer_endometri.csv"
 MODEL_PATH = BASE_DIR / "models" / "svm_model.joblib"
 SCALER_PATH = BASE_DIR / "models" / "scaler.joblib"
 FEATURES_PATH = BASE_DIR / "models" / "selected_features.joblib"
+BG_DATA_PATH = BASE_DIR / "data" / "processed" / "preprocessed.csv"
+IMAGES_DIR = BASE_DIR / "images"
 
 # CONSTANTS MAPPING
 COL_ID = "codigo_participante"
@@ -39,6 +39,133 @@ COL_TTO_SISTEMICO = "Tratamiento_sistemico_realizad"
 COL_HISTO = "histo_defin"
 COL_METASTA = "metasta_distan"
 
+# --- MAPEJATS I NOMS DE VARIABLES ---
+# Mapejats inversos per convertir UI -> valors numèrics
+RISK_INV = {"Risc baix": 1, "Risc intermedi": 2, "Risc intermedi-alt": 3, "Risc alt": 4, "Avançats": 5}
+GRADO_INV = {"Grau baix (G1-G2)": 1, "Grau alt (G3)": 2}
+INFIL_INV = {"Sense infiltració": 0, "Infiltració miometrial <50%": 1, "Infiltració miometrial >50%": 2, "Infiltració serosa": 3}
+LINF_INV = {"No": 0, "Sí": 1}
+ESTAD_INV = {"Estadi I": 0, "Estadi II": 1, "Estadi III i IV": 2}
+SIST_INV = {"No realitzat": 0, "Dosi parcial": 1, "Dosi completa": 2}
+FIGO_INV = {"IA1": 1, "IA2": 2, "IA3": 3, "IB": 4, "IC": 5, "IIA": 6, "IIB": 7, "IIC": 8, "IIIA": 9, "IIIB": 10, "IIIC": 11, "IVA": 12, "IVB": 13, "IVC": 14}
+QUIR_INV = {"No": 0, "Sí": 1}
+HISTO_INV = {"Hiperplàsia amb atípies": 1, "Carcinoma endometrioide": 2, "Carcinoma serós": 3, "Carcinoma de cèl·lules clares": 4, "Carcinoma indiferenciat": 5, "Carcinoma mixt": 6, "Carcinoma escamós": 7, "Carcinosarcoma": 8, "Altres": 9}
+META_INV = {"No": 0, "Sí": 1}
+
+# Noms llegibles per les features
+FEATURE_DISPLAY_NAMES = {
+    "grupo_de_riesgo_definitivo": "Grup de Risc",
+    "afectacion_linf": "LVSI",
+    "estadiaje_pre_i": "Estadiatge Pre",
+    "Tratamiento_sistemico_realizad": "Tto. Sistèmic",
+    "grado_histologi": "Grau Histològic",
+    "infiltracion_mi": "Infiltració MI",
+    "imc": "IMC",
+    "FIGO2023": "FIGO",
+    "recep_est_porcent": "Recep. Estrogen",
+    "rece_de_Ppor": "Recep. Progest.",
+    "edad": "Edat",
+    "tto_1_quirugico": "Tto. Quirúrgic",
+    "histo_defin": "Histologia",
+    "metasta_distan": "Metàstasi"
+}
+
+# Definir variables categòriques vs contínues
+CATEGORICAL_FEATURES = {
+    "grupo_de_riesgo_definitivo": {1: "Baix", 2: "Intermedi", 3: "Int-Alt", 4: "Alt", 5: "Avançat"},
+    "afectacion_linf": {0: "No", 1: "Sí"},
+    "estadiaje_pre_i": {0: "Estadi I", 1: "Estadi II", 2: "Estadi III-IV"},
+    "Tratamiento_sistemico_realizad": {0: "No", 1: "Parcial", 2: "Completa"},
+    "grado_histologi": {1: "Baix (G1-G2)", 2: "Alt (G3)"},
+    "infiltracion_mi": {0: "No", 1: "<50%", 2: ">50%", 3: "Serosa"},
+    "tto_1_quirugico": {0: "No", 1: "Sí"},
+    "metasta_distan": {0: "No", 1: "Sí"},
+}
+
+CONTINUOUS_FEATURES = ["imc", "recep_est_porcent", "rece_de_Ppor", "edad"]
+
+# Noms llegibles per PDP
+PDP_FEATURE_NAMES = {
+    "grupo_de_riesgo_definitivo": "Grup de Risc",
+    "afectacion_linf": "LVSI",
+    "estadiaje_pre_i": "Estadiatge Pre-quirúrgic",
+    "Tratamiento_sistemico_realizad": "Tractament Sistèmic",
+    "grado_histologi": "Grau Histològic",
+    "infiltracion_mi": "Infiltració Miometrial",
+    "imc": "IMC",
+    "FIGO2023": "Estadi FIGO",
+    "recep_est_porcent": "Receptors Estrogen (%)",
+    "rece_de_Ppor": "Receptors Progesterona (%)",
+    "edad": "Edat",
+    "tto_1_quirugico": "Tractament Quirúrgic",
+    "histo_defin": "Tipus Histològic",
+    "metasta_distan": "Metàstasi a Distància"
+}
+
+# Només mostrar variables que tenen sentit per PDP
+PDP_FEATURES = list(CATEGORICAL_FEATURES.keys()) + CONTINUOUS_FEATURES
+
+# Mapejats per fer les features llegibles
+FEATURE_NAMES = {
+    "grupo_de_riesgo_definitivo": "Grup de Risc",
+    "afectacion_linf": "Afectació Limfàtica (LVSI)",
+    "estadiaje_pre_i": "Estadiatge Pre-quirúrgic",
+    "Tratamiento_sistemico_realizad": "Tractament Sistèmic",
+    "grado_histologi": "Grau Histològic",
+    "infiltracion_mi": "Infiltració Miometrial",
+    "imc": "IMC",
+    "FIGO2023": "Estadi FIGO",
+    "recep_est_porcent": "Receptors Estrogen (%)",
+    "rece_de_Ppor": "Receptors Progesterona (%)",
+    "edad": "Edat",
+    "tto_1_quirugico": "Tractament Quirúrgic",
+    "histo_defin": "Tipus Histològic",
+    "metasta_distan": "Metàstasi a Distància"
+}
+
+RISK_MAP = {1: "Baix", 2: "Intermedi", 3: "Intermedi-Alt", 4: "Alt", 5: "Avançat"}
+GRADO_MAP = {1: "Baix grau (G1-G2)", 2: "Alt grau (G3)"}
+INFIL_MAP = {0: "No", 1: "<50%", 2: ">50%", 3: "Serosa"}
+YESNO_MAP = {0: "No", 1: "Sí"}
+ESTAD_MAP = {0: "I", 1: "II", 2: "III-IV"}
+SIST_MAP = {0: "No", 1: "Parcial", 2: "Completa"}
+FIGO_MAP = {1: "IA1", 2: "IA2", 3: "IA3", 4: "IB", 5: "IC", 6: "IIA", 7: "IIB", 8: "IIC", 9: "IIIA", 10: "IIIB", 11: "IIIC", 12: "IVA", 13: "IVB", 14: "IVC"}
+HISTO_MAP = {1: "Hiperplàsia", 2: "Endometrioide", 3: "Serós", 4: "Cèl·lules clares", 5: "Indiferenciat", 6: "Mixt", 7: "Escamós", 8: "Carcinosarcoma", 9: "Altres"}
+
+# Mapa de valors per columna categòrica
+VALUE_MAPS = {
+    "grupo_de_riesgo_definitivo": RISK_MAP,
+    "grado_histologi": GRADO_MAP,
+    "infiltracion_mi": INFIL_MAP,
+    "afectacion_linf": YESNO_MAP,
+    "tto_1_quirugico": YESNO_MAP,
+    "metasta_distan": YESNO_MAP,
+    "estadiaje_pre_i": ESTAD_MAP,
+    "Tratamiento_sistemico_realizad": SIST_MAP,
+    "FIGO2023": FIGO_MAP,
+    "histo_defin": HISTO_MAP,
+}
+FLOAT_COLS = {"recep_est_porcent", "rece_de_Ppor", "imc"}
+
+# Claus del formulari (st.session_state) que surten a l'informe PDF, en ordre de visualització
+PDF_KEYS = ("edad", "imc", "grupo_riesgo", "estadiaje_pre", "histo", "grado",
+            "infiltracion", "figo", "metasta", "tto_quirurgico", "tto_sistemico",
+            "afect_linf", "recep_est", "recep_prog")
+
+def format_value(col, val, int_val):
+    """Converteix un valor codificat d'una variable al text llegible per la taula comparativa.
+
+    int_val és el valor ja arrodonit a enter (calculat de cop per tota la taula).
+    """
+    if col in FLOAT_COLS:
+        return f"{val:.1f}"
+    value_map = VALUE_MAPS.get(col)
+    if value_map is not None:
+        return value_map.get(int_val, str(int_val))
+    if col == "edad":
+        return str(int_val)
+    return str(val)
+
 # --- Carregar model, scaler i features ---
 @st.cache_resource
 def load_model_artifacts():
@@ -47,20 +174,72 @@ def load_model_artifacts():
     features = joblib.load(FEATURES_PATH)
     return model, scaler, features
 
+def read_csv_fast(source):
+    """Llegeix un CSV amb el parser multifil de pyarrow; si no és disponible, amb el de C."""
+    try:
+        return pd.read_csv(source, engine="pyarrow")
+    except (ImportError, ValueError):
+        if hasattr(source, "seek"):
+            source.seek(0)
+        return pd.read_csv(source)
+
+def file_mtime(path):
+    """mtime d'un fitxer (o None si no existeix), per invalidar les caches quan canvia."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
 @st.cache_data
-def load_data(file_buffer=None):
+def load_background_data(_scaler, features, mtime=None):
+    """Carrega i escala les dades de fons (preprocessed.csv). Es recarrega només si canvia l'mtime."""
+    if not BG_DATA_PATH.exists():
+        return None
+    bg_df = read_csv_fast(BG_DATA_PATH)
+    X_bg = bg_df[features].to_numpy()
+    X_bg_scaled = _scaler.transform(X_bg)
+    # Vector mitjà (punt de referència del PDP)
+    X_mean = X_bg.mean(axis=0)
+    # Normes al quadrat precalculades per a la cerca de casos similars
+    bg_sq_norms = np.einsum("ij,ij->i", X_bg_scaled, X_bg_scaled)
+    y_bg = bg_df["recidiva_exitus"].to_numpy()
+    return X_bg, X_bg_scaled, X_mean, bg_sq_norms, y_bg
+
+@st.cache_resource
+def load_image_bytes(path, mtime):
+    """Llegeix una imatge del disc. L'mtime forma part de la clau perquè es recarregui si canvia."""
+    return Path(path).read_bytes()
+
+@st.cache_data(ttl=60)
+def list_images(images_dir):
+    """Noms i mtime dels fitxers d'un directori amb una sola lectura (os.scandir)."""
+    if not os.path.isdir(images_dir):
+        return {}
+    with os.scandir(images_dir) as entries:
+        return {e.name: e.stat().st_mtime for e in entries if e.is_file()}
+
+def show_image(filename, available):
+    """Mostra una imatge de IMAGES_DIR (o un avís si encara no existeix)."""
+    mtime = available.get(filename)
+    if mtime is not None:
+        st.image(load_image_bytes(str(IMAGES_DIR / filename), mtime), width='stretch')
+    else:
+        st.warning(f"⏳ Imatge `{filename}` pendent de pujar")
+
+@st.cache_data
+def load_data(file_buffer=None, mtime=None):
     source = file_buffer if file_buffer else DATA_PATH
     if not source and not os.path.exists(DATA_PATH):
         return None
     try:
         if file_buffer:
             if file_buffer.name.endswith('.csv'):
-                df = pd.read_csv(source)
+                df = read_csv_fast(source)
             else:
                 df = pd.read_excel(source)
         else:
             if str(source).endswith('.csv'):
-                df = pd.read_csv(source)
+                df = read_csv_fast(source)
             else:
                 df = pd.read_excel(source)
         if COL_ID in df.columns:
@@ -69,8 +248,14 @@ def load_data(file_buffer=None):
     except Exception:
         return None
 
-def generate_pdf_report(prob, risk_level, original_values, shap_values, features):
-    """Genera un informe PDF amb la predicció i dades rellevants."""
+@st.cache_data(max_entries=32)
+def generate_pdf_report(prob, original_values, shap_values, features, generated_at):
+    """Genera un informe PDF amb la predicció i dades rellevants.
+    
+    Es cacheja per entrada (inclosa la data de generació): els reruns amb la mateixa
+    predicció no tornen a construir el document.
+    """
+    from fpdf import FPDF
     
     # Noms llegibles per les variables
     FEATURE_DISPLAY = {
@@ -108,7 +293,7 @@ def generate_pdf_report(prob, risk_level, original_values, shap_values, features
     pdf.set_font("Helvetica", "", 10)
     pdf.set_text_color(127, 140, 141)  # Gris suau
     pdf.cell(0, 8, "Eina de Prediccio de Recurrencia en Cancer Endometrial NSMP", ln=True, align="C")
-    pdf.cell(0, 6, f"Data: {datetime.now().strftime('%d/%m/%Y %H:%M')}", ln=True, align="C")
+    pdf.cell(0, 6, f"Data: {generated_at.strftime('%d/%m/%Y %H:%M')}", ln=True, align="C")
     pdf.ln(8)
     
     # Línia separadora
@@ -156,19 +341,14 @@ def generate_pdf_report(prob, risk_level, original_values, shap_values, features
     col_width = 70
     row_height = 6
     
-    # Ordre de les variables per mostrar
-    display_order = ["edad", "imc", "grupo_riesgo", "estadiaje_pre", "histo", "grado", 
-                     "infiltracion", "figo", "metasta", "tto_quirurgico", "tto_sistemico", 
-                     "afect_linf", "recep_est", "recep_prog"]
-    
-    for i, key in enumerate(display_order):
+    # original_values va alineat amb PDF_KEYS
+    for i, (key, val) in enumerate(zip(PDF_KEYS, original_values)):
         if i % 2 == 0:
             pdf.set_fill_color(248, 249, 250)
         else:
             pdf.set_fill_color(255, 255, 255)
         
         feat_name = FEATURE_DISPLAY.get(key, key)
-        val = original_values.get(key)
         val_str = format_original_val(key, val)
         
         pdf.set_font("Helvetica", "B", 8)
@@ -236,8 +416,78 @@ def generate_pdf_report(prob, risk_level, original_values, shap_values, features
     pdf.cell(0, 5, "EndoRisk - Eina de Prediccio de Recurrencia en Cancer Endometrial NSMP", ln=True, align="C")
     pdf.cell(0, 5, "Aquest informe es genera automaticament. No substitueix el criteri medic professional.", ln=True, align="C")
     
-    # Retornar bytes
-    return bytes(pdf.output())
+    # Escriure al buffer i retornar bytes immutables (st.cache_data en dona una còpia a cada sessió)
+    buf = io.BytesIO()
+    pdf.output(buf)
+    return buf.getvalue()
+
+
+@st.cache_data(max_entries=32)
+def build_shap_figure(shap_bytes, labels):
+    """Construeix el gràfic de barres SHAP. La clau de cache són els bytes dels valors."""
+    import plotly.graph_objects as go
+    
+    shap_values = np.frombuffer(shap_bytes, dtype=np.float64)
+    n_vars = len(shap_values)
+    colors = ["#ff1744" if v > 0 else "#00c853" for v in shap_values]
+    fig = go.Figure(go.Bar(x=shap_values, y=list(labels), orientation="h", marker_color=colors, width=0.6))
+    fig.add_vline(x=0, line_dash="dash", line_color="gray", opacity=0.5)
+    fig.update_layout(
+        title=f"Top {n_vars} Variables Més Significatives (SHAP)",
+        xaxis_title="Impacte en la probabilitat de recurrència",
+        height=max(400, n_vars * 50),
+        margin=dict(l=10, r=10, t=50, b=10),
+        yaxis=dict(tickfont=dict(size=13)),
+    )
+    # Expandir eix x per veure totes les barres
+    max_val = np.abs(shap_values).max() if n_vars else 0
+    if max_val > 0:
+        fig.update_xaxes(range=[-max_val * 1.3, max_val * 1.3])
+    return fig
+
+
+@st.cache_data(max_entries=32)
+def build_pdp_figure(_model, _scaler, x_mean_bytes, feat_idx, feat_label, categories=None, value_range=None):
+    """Construeix el PDP d'una variable: barres si és categòrica (categories), línia si és contínua (value_range)."""
+    import plotly.graph_objects as go
+    
+    X_mean = np.frombuffer(x_mean_bytes, dtype=np.float64)
+    
+    if categories is not None:
+        # Variable categòrica -> usar barres (una sola predicció per totes les categories)
+        X_temp = np.broadcast_to(X_mean, (len(categories), X_mean.size)).copy()
+        X_temp[:, feat_idx] = [cat_val for cat_val, _ in categories]
+        pdp_values = _model.predict_proba(_scaler.transform(X_temp))[:, 1]
+        
+        # Colors segons probabilitat
+        colors = ['#00c853' if p < 0.3 else '#ffab00' if p < 0.6 else '#ff1744' for p in pdp_values]
+        labels = [label for _, label in categories]
+        
+        # Valors sobre les barres
+        fig_pdp = go.Figure(go.Bar(
+            x=labels, y=pdp_values, marker_color=colors, marker_line=dict(color="white", width=2),
+            text=[f"{val:.1%}" for val in pdp_values], textposition="outside", textfont=dict(size=13),
+        ))
+        fig_pdp.update_yaxes(range=[0, 1])
+    else:
+        # Variable contínua -> usar línia (25 punts són suficients per una corba suau)
+        grid_values = np.linspace(value_range[0], value_range[1], 25)
+        X_temp = np.broadcast_to(X_mean, (len(grid_values), X_mean.size)).copy()
+        X_temp[:, feat_idx] = grid_values
+        pdp_values = _model.predict_proba(_scaler.transform(X_temp))[:, 1]
+        
+        fig_pdp = go.Figure(go.Scatter(
+            x=grid_values, y=pdp_values, mode="lines", line=dict(color="blue", width=2), fill="tozeroy",
+        ))
+    
+    fig_pdp.update_layout(
+        title=f"Partial Dependence Plot: {feat_label}",
+        xaxis_title=feat_label,
+        yaxis_title="Probabilitat de Recurrència",
+        height=450,
+        margin=dict(l=10, r=10, t=50, b=10),
+    )
+    return fig_pdp
 
 
 # Configuració de la pàgina
@@ -316,11 +566,21 @@ st.markdown("**Eina de Predicció de Recurrència en Càncer Endometrial NSMP**"
 # Carregar artefactes del model
 try:
     model, scaler, SELECTED_FEATURES = load_model_artifacts()
+    # Etiquetes llegibles en l'ordre de SELECTED_FEATURES (per indexar-les directament)
+    SELECTED_FEATURE_LABELS = np.array([FEATURE_DISPLAY_NAMES.get(f, f) for f in SELECTED_FEATURES])
     model_loaded = True
 except Exception as e:
     model_loaded = False
     st.error(f"Error carregant el model: {e}")
 
+# Dades de fons compartides per SHAP, PDP i casos similars (carregades i escalades una sola vegada)
+bg_data = None
+if model_loaded:
+    try:
+        bg_data = load_background_data(scaler, SELECTED_FEATURES, file_mtime(BG_DATA_PATH))
+    except Exception:
+        bg_data = None
+
 # --- SIDEBAR: SIMULACIÓ BASE DE DADES HOSPITAL ---
 with st.sidebar:
     st.header("📂 Base de Dades Hospital")
@@ -332,7 +592,7 @@ with st.sidebar:
         df = load_data(uploaded_file)
         # Si falla la càrrega del fitxer pujat, fallback silenciós al path
         if df is None:
-            df = load_data(None)  # Intenta carregar des del path
+            df = load_data(None, file_mtime(DATA_PATH))  # Intenta carregar des del path
     
     patient_id_input = st.text_input("Buscar ID Pacient", placeholder="Ex: 12345")
     patient = None
@@ -499,18 +759,6 @@ with tab1:
             submitted = st.form_submit_button("Calcular Risc de Recurrència", use_container_width=True, type="primary")
 
     if submitted and model_loaded:
-        # Mapejats inversos per convertir UI -> valors numèrics
-        RISK_INV = {"Risc baix": 1, "Risc intermedi": 2, "Risc intermedi-alt": 3, "Risc alt": 4, "Avançats": 5}
-        GRADO_INV = {"Grau baix (G1-G2)": 1, "Grau alt (G3)": 2}
-        INFIL_INV = {"Sense infiltració": 0, "Infiltració miometrial <50%": 1, "Infiltració miometrial >50%": 2, "Infiltració serosa": 3}
-        LINF_INV = {"No": 0, "Sí": 1}
-        ESTAD_INV = {"Estadi I": 0, "Estadi II": 1, "Estadi III i IV": 2}
-        SIST_INV = {"No realitzat": 0, "Dosi parcial": 1, "Dosi completa": 2}
-        FIGO_INV = {"IA1": 1, "IA2": 2, "IA3": 3, "IB": 4, "IC": 5, "IIA": 6, "IIB": 7, "IIC": 8, "IIIA": 9, "IIIB": 10, "IIIC": 11, "IVA": 12, "IVB": 13, "IVC": 14}
-        QUIR_INV = {"No": 0, "Sí": 1}
-        HISTO_INV = {"Hiperplàsia amb atípies": 1, "Carcinoma endometrioide": 2, "Carcinoma serós": 3, "Carcinoma de cèl·lules clares": 4, "Carcinoma indiferenciat": 5, "Carcinoma mixt": 6, "Carcinoma escamós": 7, "Carcinosarcoma": 8, "Altres": 9}
-        META_INV = {"No": 0, "Sí": 1}
-        
         # =================================================================
         # COMPTAR CAMPS BUITS (NANs) per calcular confiança
         # =================================================================
@@ -634,15 +882,15 @@ with tab1:
         # SHAP amb dades de fons (optimitzat per velocitat)
         with st.spinner("Calculant interpretabilitat..."):
             try:
-                bg_data_path = BASE_DIR / "data" / "processed" / "preprocessed.csv"
-                if bg_data_path.exists():
-                    bg_df = pd.read_csv(bg_data_path)
-                    X_bg = bg_df[SELECTED_FEATURES]
-                    X_bg_scaled = scaler.transform(X_bg)
+                if bg_data is not None:
+                    _, X_bg_scaled, _, _, _ = bg_data
                     # Reduït per accelerar
                     sample_size = min(20, len(X_bg_scaled))
                     background = X_bg_scaled[:sample_size]
                     
+                    # Explainer nou per predicció: KernelExplainer desa estat a la instància
+                    # durant shap_values(), i no es pot compartir entre sessions (fils)
+                    import shap
                     explainer = shap.KernelExplainer(model.predict_proba, background)
                     shap_vals = explainer.shap_values(input_scaled, nsamples=50)
                     # Agafar la classe positiva (index 1)
@@ -792,56 +1040,25 @@ with tab2:
                 else:
                     shap_flat = np.pad(shap_flat, (0, n_features - len(shap_flat)), 'constant')
                 
-                # Noms llegibles per les features
-                FEATURE_DISPLAY_NAMES = {
-                    "grupo_de_riesgo_definitivo": "Grup de Risc",
-                    "afectacion_linf": "LVSI",
-                    "estadiaje_pre_i": "Estadiatge Pre",
-                    "Tratamiento_sistemico_realizad": "Tto. Sistèmic",
-                    "grado_histologi": "Grau Histològic",
-                    "infiltracion_mi": "Infiltració MI",
-                    "imc": "IMC",
-                    "FIGO2023": "FIGO",
-                    "recep_est_porcent": "Recep. Estrogen",
-                    "rece_de_Ppor": "Recep. Progest.",
-                    "edad": "Edat",
-                    "tto_1_quirugico": "Tto. Quirúrgic",
-                    "histo_defin": "Histologia",
-                    "metasta_distan": "Metàstasi"
-                }
-                
-                shap_df = pd.DataFrame({
-                    "Feature": [FEATURE_DISPLAY_NAMES.get(f, f) for f in SELECTED_FEATURES],
-                    "SHAP Value": shap_flat,
-                })
-                
                 # Filtrar variables amb contribució significativa (>1% del màxim)
-                max_abs = shap_df["SHAP Value"].abs().max()
-                threshold = max_abs * 0.01  # 1% del valor màxim
-                shap_df = shap_df[shap_df["SHAP Value"].abs() > threshold]
+                abs_vals = np.abs(shap_flat)
+                significant_idx = np.flatnonzero(abs_vals > abs_vals.max() * 0.01)
                 
                 # Agafar fins a top 10 més significatives
-                shap_df = shap_df.sort_values("SHAP Value", key=abs, ascending=False).head(10)
+                order = significant_idx[np.argsort(-abs_vals[significant_idx], kind="stable")][:10]
                 # Re-ordenar de menor a major per barh (els de baix apareixen a dalt)
-                shap_df = shap_df.sort_values("SHAP Value", key=abs, ascending=True)
+                order = order[::-1]
+                
+                shap_df = pd.DataFrame({
+                    "Feature": SELECTED_FEATURE_LABELS[order],
+                    "SHAP Value": shap_flat[order],
+                })
                 
-                n_vars = len(shap_df)
-                fig_height = max(4, n_vars * 0.5)
-                fig, ax = plt.subplots(figsize=(10, fig_height))
-                colors = ["#ff1744" if v > 0 else "#00c853" for v in shap_df["SHAP Value"]]
-                bars = ax.barh(range(len(shap_df)), shap_df["SHAP Value"].values, color=colors, height=0.6)
-                ax.set_yticks(range(len(shap_df)))
-                ax.set_yticklabels(shap_df["Feature"].values)
-                ax.set_xlabel("Impacte en la probabilitat de recurrència")
-                ax.set_title(f"Top {n_vars} Variables Més Significatives (SHAP)")
-                ax.axvline(x=0, color='gray', linestyle='--', alpha=0.5)
-                ax.tick_params(axis='y', labelsize=11)
-                # Expandir eix x per veure totes les barres
-                max_val = max(abs(shap_df["SHAP Value"].max()), abs(shap_df["SHAP Value"].min()))
-                if max_val > 0:
-                    ax.set_xlim(-max_val * 1.3, max_val * 1.3)
-                plt.tight_layout()
-                st.pyplot(fig)
+                fig = build_shap_figure(
+                    shap_df["SHAP Value"].to_numpy(dtype=np.float64).tobytes(),
+                    tuple(shap_df["Feature"]),
+                )
+                st.plotly_chart(fig, use_container_width=True)
                 
                 st.caption("🔴 Vermell = Augmenta el risc | 🟢 Verd = Redueix el risc")
             except Exception as e:
@@ -858,111 +1075,43 @@ with tab2:
         - Per **variables contínues**: La línia mostra com varia la probabilitat a mesura que augmenta el valor.
         """)
         
-        # Definir variables categòriques vs contínues
-        CATEGORICAL_FEATURES = {
-            "grupo_de_riesgo_definitivo": {1: "Baix", 2: "Intermedi", 3: "Int-Alt", 4: "Alt", 5: "Avançat"},
-            "afectacion_linf": {0: "No", 1: "Sí"},
-            "estadiaje_pre_i": {0: "Estadi I", 1: "Estadi II", 2: "Estadi III-IV"},
-            "Tratamiento_sistemico_realizad": {0: "No", 1: "Parcial", 2: "Completa"},
-            "grado_histologi": {1: "Baix (G1-G2)", 2: "Alt (G3)"},
-            "infiltracion_mi": {0: "No", 1: "<50%", 2: ">50%", 3: "Serosa"},
-            "tto_1_quirugico": {0: "No", 1: "Sí"},
-            "metasta_distan": {0: "No", 1: "Sí"},
-        }
-        
-        CONTINUOUS_FEATURES = ["imc", "recep_est_porcent", "rece_de_Ppor", "edad"]
-        
-        # Noms llegibles per PDP
-        PDP_FEATURE_NAMES = {
-            "grupo_de_riesgo_definitivo": "Grup de Risc",
-            "afectacion_linf": "LVSI",
-            "estadiaje_pre_i": "Estadiatge Pre-quirúrgic",
-            "Tratamiento_sistemico_realizad": "Tractament Sistèmic",
-            "grado_histologi": "Grau Histològic",
-            "infiltracion_mi": "Infiltració Miometrial",
-            "imc": "IMC",
-            "FIGO2023": "Estadi FIGO",
-            "recep_est_porcent": "Receptors Estrogen (%)",
-            "rece_de_Ppor": "Receptors Progesterona (%)",
-            "edad": "Edat",
-            "tto_1_quirugico": "Tractament Quirúrgic",
-            "histo_defin": "Tipus Histològic",
-            "metasta_distan": "Metàstasi a Distància"
-        }
-        
-        # Només mostrar variables que tenen sentit per PDP
-        PDP_FEATURES = list(CATEGORICAL_FEATURES.keys()) + CONTINUOUS_FEATURES
-        
-        pdp_feature = st.selectbox(
-            "Selecciona una variable per veure el PDP:", 
-            PDP_FEATURES,
-            format_func=lambda x: PDP_FEATURE_NAMES.get(x, x)
-        )
-        
-        if pdp_feature and model_loaded:
-            try:
-                bg_data_path = BASE_DIR / "data" / "processed" / "preprocessed.csv"
-                if bg_data_path.exists():
-                    bg_df = pd.read_csv(bg_data_path)
-                    X_bg = bg_df[SELECTED_FEATURES]
-                    
-                    feat_idx = SELECTED_FEATURES.index(pdp_feature)
-                    X_mean = X_bg.mean().values
-                    
-                    fig_pdp, ax_pdp = plt.subplots(figsize=(10, 5))
-                    
-                    if pdp_feature in CATEGORICAL_FEATURES:
-                        # Variable categòrica -> usar barres
-                        cat_map = CATEGORICAL_FEATURES[pdp_feature]
-                        categories = sorted(cat_map.keys())
-                        pdp_values = []
-                        
-                        for cat_val in categories:
-                            X_temp = np.tile(X_mean, (1, 1))
-                            X_temp[0, feat_idx] = cat_val
-                            X_temp_scaled = scaler.transform(X_temp)
-                            pred = model.predict_proba(X_temp_scaled)[0][1]
-                            pdp_values.append(pred)
+        # Fragment: canviar la variable només re-executa aquest bloc, no tota la pàgina
+        @st.fragment
+        def pdp_section():
+            pdp_feature = st.selectbox(
+                "Selecciona una variable per veure el PDP:", 
+                PDP_FEATURES,
+                format_func=lambda x: PDP_FEATURE_NAMES.get(x, x)
+            )
+            
+            if pdp_feature and model_loaded:
+                try:
+                    if bg_data is not None:
+                        X_bg, _, X_mean, _, _ = bg_data
                         
-                        # Colors segons probabilitat
-                        colors = ['#00c853' if p < 0.3 else '#ffab00' if p < 0.6 else '#ff1744' for p in pdp_values]
-                        labels = [cat_map.get(c, str(c)) for c in categories]
+                        feat_idx = SELECTED_FEATURES.index(pdp_feature)
                         
-                        bars = ax_pdp.bar(range(len(categories)), pdp_values, color=colors, edgecolor='white', linewidth=2)
-                        ax_pdp.set_xticks(range(len(categories)))
-                        ax_pdp.set_xticklabels(labels, rotation=0, fontsize=10)
-                        ax_pdp.set_ylim(0, 1)
+                        if pdp_feature in CATEGORICAL_FEATURES:
+                            cat_map = CATEGORICAL_FEATURES[pdp_feature]
+                            categories = tuple((c, cat_map.get(c, str(c))) for c in sorted(cat_map.keys()))
+                            value_range = None
+                        else:
+                            feat_values = X_bg[:, feat_idx]
+                            categories = None
+                            value_range = (float(feat_values.min()), float(feat_values.max()))
                         
-                        # Afegir valors sobre les barres
-                        for bar, val in zip(bars, pdp_values):
-                            ax_pdp.text(bar.get_x() + bar.get_width()/2, bar.get_height() + 0.02, 
-                                       f'{val:.1%}', ha='center', va='bottom', fontsize=10, fontweight='bold')
+                        fig_pdp = build_pdp_figure(
+                            model, scaler, np.asarray(X_mean, dtype=np.float64).tobytes(), feat_idx,
+                            PDP_FEATURE_NAMES.get(pdp_feature, pdp_feature),
+                            categories=categories, value_range=value_range,
+                        )
+                        st.plotly_chart(fig_pdp, use_container_width=True)
                     else:
-                        # Variable contínua -> usar línia
-                        feat_values = X_bg[pdp_feature].values
-                        grid_values = np.linspace(feat_values.min(), feat_values.max(), 50)
-                        pdp_values = []
-                        
-                        for val in grid_values:
-                            X_temp = np.tile(X_mean, (1, 1))
-                            X_temp[0, feat_idx] = val
-                            X_temp_scaled = scaler.transform(X_temp)
-                            pred = model.predict_proba(X_temp_scaled)[0][1]
-                            pdp_values.append(pred)
-                        
-                        ax_pdp.plot(grid_values, pdp_values, 'b-', linewidth=2)
-                        ax_pdp.fill_between(grid_values, pdp_values, alpha=0.3)
-                    
-                    ax_pdp.set_xlabel(PDP_FEATURE_NAMES.get(pdp_feature, pdp_feature))
-                    ax_pdp.set_ylabel("Probabilitat de Recurrència")
-                    ax_pdp.set_title(f"Partial Dependence Plot: {PDP_FEATURE_NAMES.get(pdp_feature, pdp_feature)}")
-                    ax_pdp.grid(True, alpha=0.3, axis='y')
-                    plt.tight_layout()
-                    st.pyplot(fig_pdp)
-                else:
-                    st.warning("No s'han trobat dades de fons per generar el PDP.")
-            except Exception as e:
-                st.error(f"Error generant PDP: {e}")
+                        st.warning("No s'han trobat dades de fons per generar el PDP.")
+                except Exception as e:
+                    st.error(f"Error generant PDP: {e}")
+            
+        pdp_section()
         
         # --- CASOS SIMILARS ---
         st.divider()
@@ -973,251 +1122,112 @@ with tab2:
         """)
         
         try:
-            bg_data_path = BASE_DIR / "data" / "processed" / "preprocessed.csv"
-            if bg_data_path.exists() and st.session_state.input_data is not None:
-                bg_df = pd.read_csv(bg_data_path)
-                X_bg = bg_df[SELECTED_FEATURES]
-                y_bg = bg_df["recidiva_exitus"]
-                X_bg_scaled = scaler.transform(X_bg)
+            if bg_data is not None and st.session_state.input_data is not None:
+                X_bg, X_bg_scaled, _, bg_sq_norms, y_bg = bg_data
                 
-                # Calcular distància Euclidiana
                 input_vec = st.session_state.input_data.values.flatten()
-                distances = np.sqrt(np.sum((X_bg_scaled - input_vec) ** 2, axis=1))
-                
-                # Ordenar per distància i filtrar els que tenen distància 0 (és el mateix cas)
-                sorted_idx = np.argsort(distances)
-                similar_idx = [idx for idx in sorted_idx if distances[idx] > 0.001][:2]  # Agafar 2 casos
-                
-                # Mapejats per fer les features llegibles
-                FEATURE_NAMES = {
-                    "grupo_de_riesgo_definitivo": "Grup de Risc",
-                    "afectacion_linf": "Afectació Limfàtica (LVSI)",
-                    "estadiaje_pre_i": "Estadiatge Pre-quirúrgic",
-                    "Tratamiento_sistemico_realizad": "Tractament Sistèmic",
-                    "grado_histologi": "Grau Histològic",
-                    "infiltracion_mi": "Infiltració Miometrial",
-                    "imc": "IMC",
-                    "FIGO2023": "Estadi FIGO",
-                    "recep_est_porcent": "Receptors Estrogen (%)",
-                    "rece_de_Ppor": "Receptors Progesterona (%)",
-                    "edad": "Edat",
-                    "tto_1_quirugico": "Tractament Quirúrgic",
-                    "histo_defin": "Tipus Histològic",
-                    "metasta_distan": "Metàstasi a Distància"
-                }
-                
-                RISK_MAP = {1: "Baix", 2: "Intermedi", 3: "Intermedi-Alt", 4: "Alt", 5: "Avançat"}
-                GRADO_MAP = {1: "Baix grau (G1-G2)", 2: "Alt grau (G3)"}
-                INFIL_MAP = {0: "No", 1: "<50%", 2: ">50%", 3: "Serosa"}
-                YESNO_MAP = {0: "No", 1: "Sí"}
-                ESTAD_MAP = {0: "I", 1: "II", 2: "III-IV"}
-                SIST_MAP = {0: "No", 1: "Parcial", 2: "Completa"}
-                FIGO_MAP = {1: "IA1", 2: "IA2", 3: "IA3", 4: "IB", 5: "IC", 6: "IIA", 7: "IIB", 8: "IIC", 9: "IIIA", 10: "IIIB", 11: "IIIC", 12: "IVA", 13: "IVB", 14: "IVC"}
-                HISTO_MAP = {1: "Hiperplàsia", 2: "Endometrioide", 3: "Serós", 4: "Cèl·lules clares", 5: "Indiferenciat", 6: "Mixt", 7: "Escamós", 8: "Carcinosarcoma", 9: "Altres"}
-                
-                def format_value(col, val):
-                    try:
-                        v = int(round(val))
-                    except:
-                        v = val
-                    if col == "grupo_de_riesgo_definitivo":
-                        return RISK_MAP.get(v, str(v))
-                    elif col == "grado_histologi":
-                        return GRADO_MAP.get(v, str(v))
-                    elif col == "infiltracion_mi":
-                        return INFIL_MAP.get(v, str(v))
-                    elif col in ["afectacion_linf", "tto_1_quirugico", "metasta_distan"]:
-                        return YESNO_MAP.get(v, str(v))
-                    elif col == "estadiaje_pre_i":
-                        return ESTAD_MAP.get(v, str(v))
-                    elif col == "Tratamiento_sistemico_realizad":
-                        return SIST_MAP.get(v, str(v))
-                    elif col == "FIGO2023":
-                        return FIGO_MAP.get(v, str(v))
-                    elif col == "histo_defin":
-                        return HISTO_MAP.get(v, str(v))
-                    elif col in ["recep_est_porcent", "rece_de_Ppor", "imc"]:
-                        return f"{val:.1f}"
-                    elif col == "edad":
-                        return str(v)
-                    return str(val)
+                # Calcular distància Euclidiana al quadrat: ||a-b||² = ||a||² - 2a·b + ||b||²
+                # (sense arrel: és monòtona i només ens interessa l'ordre)
+                distances = bg_sq_norms - 2 * (X_bg_scaled @ input_vec) + input_vec @ input_vec
+                np.maximum(distances, 0, out=distances)
                 
-                # Obtenir valors originals del nostre cas (desescalats)
-                RISK_INV = {"Riesgo bajo": 1, "Riesgo intermedio": 2, "Riesgo intermedio-alto": 3, "Riesgo alto": 4, "Avanzados": 5}
-                GRADO_INV = {"Bajo grado (G1-G2)": 1, "Alto grado (G3)": 2}
-                INFIL_INV = {"No infiltracion": 0, "Infiltracion miometrial <50%": 1, "Infiltracion miometrial >50%": 2, "Infiltracion serosa": 3}
-                LINF_INV = {"No": 0, "Si": 1}
-                ESTAD_INV = {"Estadio I": 0, "Estadio II": 1, "Estadio III y IV": 2}
-                SIST_INV = {"No realizada": 0, "Dosis parcial": 1, "Dosis completa": 2}
-                FIGO_INV = {"IA1": 1, "IA2": 2, "IA3": 3, "IB": 4, "IC": 5, "IIA": 6, "IIB": 7, "IIC": 8, "IIIA": 9, "IIIB": 10, "IIIC": 11, "IVA": 12, "IVB": 13, "IVC": 14}
-                QUIR_INV = {"No": 0, "Si": 1}
-                HISTO_INV = {"Hiperplasia con atipias": 1, "Carcinoma endometrioide": 2, "Carcinoma seroso": 3, "Carcinoma de celulas claras": 4, "Carcinoma Indiferenciado": 5, "Carcinoma mixto": 6, "Carcinoma escamoso": 7, "Carcinosarcoma": 8, "Otros": 9}
-                META_INV = {"No": 0, "Si": 1}
+                # Excloure els casos amb distància 0 (és el mateix cas) abans de seleccionar
+                distances[distances <= 1e-6] = np.inf
+                n_valid = int(np.count_nonzero(np.isfinite(distances)))
                 
-                our_case_original = {
-                    "grupo_de_riesgo_definitivo": RISK_INV.get(st.session_state.grupo_riesgo, 1),
-                    "afectacion_linf": LINF_INV.get(st.session_state.afect_linf, 0),
-                    "estadiaje_pre_i": ESTAD_INV.get(st.session_state.estadiaje_pre, 0),
-                    "Tratamiento_sistemico_realizad": SIST_INV.get(st.session_state.tto_sistemico, 0),
-                    "grado_histologi": GRADO_INV.get(st.session_state.grado, 1),
-                    "infiltracion_mi": INFIL_INV.get(st.session_state.infiltracion, 1),
-                    "imc": st.session_state.imc if st.session_state.imc else 29.4,
-                    "FIGO2023": FIGO_INV.get(st.session_state.figo, 1),
-                    "recep_est_porcent": st.session_state.recep_est if st.session_state.recep_est else 90.0,
-                    "rece_de_Ppor": st.session_state.recep_prog if st.session_state.recep_prog else 90.0,
-                    "edad": st.session_state.edad if st.session_state.edad else 65,
-                    "tto_1_quirugico": QUIR_INV.get(st.session_state.tto_quirurgico, 1),
-                    "histo_defin": HISTO_INV.get(st.session_state.histo, 2),
-                    "metasta_distan": META_INV.get(st.session_state.metasta, 0),
-                }
-                
-                # Construir la taula comparativa
-                outcomes = [y_bg.iloc[idx] for idx in similar_idx]
-                
-                # Crear DataFrame per a la taula
-                table_data = []
-                for feat in SELECTED_FEATURES:
-                    row = {
-                        "Variable": FEATURE_NAMES.get(feat, feat),
-                        "Cas Actual": format_value(feat, our_case_original[feat]),
-                    }
-                    for i, idx in enumerate(similar_idx):
-                        case_data = X_bg.iloc[idx]
-                        outcome_emoji = "🟢" if outcomes[i] == 0 else "🔴"
-                        row[f"Similar #{i+1} {outcome_emoji}"] = format_value(feat, case_data[feat])
-                    table_data.append(row)
-                
-                # Afegir fila de resultat
-                result_row = {
-                    "Variable": "**RESULTAT**",
-                    "Cas Actual": f"Predicció: {prob:.1%}",
-                }
-                for i, idx in enumerate(similar_idx):
-                    outcome = outcomes[i]
-                    outcome_emoji = "🟢" if outcome == 0 else "🔴"
-                    outcome_text = "No Recidiva" if outcome == 0 else "Recidiva"
-                    result_row[f"Similar #{i+1} {outcome_emoji}"] = outcome_text
-                table_data.insert(0, result_row)
-                
-                # Generar taula HTML estilitzada
-                # Determinar color segons probabilitat
-                if prob < 0.5:
-                    current_header_bg = "linear-gradient(135deg, #276749 0%, #38a169 100%)"
-                    current_val_bg = "linear-gradient(90deg, rgba(56, 161, 105, 0.15) 0%, transparent 100%)"
-                    current_val_color = "#276749"
+                # Seleccionar els 2 més propers (selecció parcial, sense ordenar tot el dataset)
+                k = min(2, n_valid)
+                if k == 0:
+                    similar_idx = []
                 else:
-                    current_header_bg = "linear-gradient(135deg, #9b2c2c 0%, #c53030 100%)"
-                    current_val_bg = "linear-gradient(90deg, rgba(197, 48, 48, 0.15) 0%, transparent 100%)"
-                    current_val_color = "#9b2c2c"
-                
-                html_table = f"""
-                <style>
-                .comparison-table {{
-                    width: 100%;
-                    border-collapse: separate;
-                    border-spacing: 0;
-                    font-family: 'Segoe UI', sans-serif;
-                    border-radius: 12px;
-                    overflow: hidden;
-                    box-shadow: 0 4px 20px rgba(0, 0, 0, 0.15);
-                }}
-                .comparison-table th {{
-                    background: linear-gradient(135deg, #2d3748 0%, #4a5568 100%);
-                    color: white;
-                    padding: 15px 12px;
-                    text-align: center;
-                    font-weight: 600;
-                    font-size: 14px;
-                    border-bottom: 3px solid #4a5568;
-                }}
-                .comparison-table th.current-case {{
-                    background: {current_header_bg};
-                }}
-                .comparison-table th.similar-green {{
-                    background: linear-gradient(135deg, #276749 0%, #38a169 100%);
-                }}
-                .comparison-table th.similar-red {{
-                    background: linear-gradient(135deg, #9b2c2c 0%, #c53030 100%);
-                }}
-                .comparison-table td {{
-                    padding: 12px;
-                    text-align: center;
-                    border-bottom: 1px solid rgba(102, 126, 234, 0.2);
-                    font-size: 13px;
-                }}
-                .comparison-table tr:nth-child(even) {{
-                    background-color: rgba(102, 126, 234, 0.05);
-                }}
-                .comparison-table tr:hover {{
-                    background-color: rgba(102, 126, 234, 0.1);
-                    transition: background-color 0.3s ease;
-                }}
-                .comparison-table td.var-name {{
-                    font-weight: 600;
-                    text-align: left;
-                    background: linear-gradient(90deg, rgba(102, 126, 234, 0.1) 0%, transparent 100%);
-                    color: #4a5568;
-                }}
-                .comparison-table td.current-val {{
-                    background: {current_val_bg};
-                    font-weight: 500;
-                    color: {current_val_color};
-                }}
-                .comparison-table tr.result-row {{
-                    background: linear-gradient(90deg, rgba(102, 126, 234, 0.15) 0%, rgba(118, 75, 162, 0.15) 100%);
-                    font-weight: 700;
-                }}
-                .comparison-table tr.result-row td {{
-                    padding: 15px 12px;
-                    font-size: 14px;
-                    border-top: 2px solid #667eea;
-                }}
-                .result-good {{ color: #38a169; }}
-                .result-bad {{ color: #e53e3e; }}
-                </style>
-                <table class="comparison-table">
-                <thead><tr>
-                    <th>Variable</th>
-                    <th class="current-case">Cas Actual</th>
-                """
+                    candidates = np.argpartition(distances, k - 1)[:k]
+                    similar_idx = candidates[np.argsort(distances[candidates])].tolist()
                 
-                for i, idx in enumerate(similar_idx):
-                    outcome = outcomes[i]
-                    class_name = "similar-green" if outcome == 0 else "similar-red"
-                    outcome_text = "No Recidiva" if outcome == 0 else "Recidiva"
-                    html_table += f'<th class="{class_name}">Similar #{i+1}<br><small>({outcome_text})</small></th>'
-                
-                html_table += "</tr></thead><tbody>"
-                
-                # Files de dades
-                for feat in SELECTED_FEATURES:
-                    var_name = FEATURE_NAMES.get(feat, feat)
-                    current_val = format_value(feat, our_case_original[feat])
+                if not similar_idx:
+                    st.warning("No s'han trobat casos similars diferents del cas actual.")
+                else:
+                    # Obtenir valors originals del nostre cas (desescalats)
+                    our_case_original = {
+                        "grupo_de_riesgo_definitivo": RISK_INV.get(st.session_state.grupo_riesgo, 1),
+                        "afectacion_linf": LINF_INV.get(st.session_state.afect_linf, 0),
+                        "estadiaje_pre_i": ESTAD_INV.get(st.session_state.estadiaje_pre, 0),
+                        "Tratamiento_sistemico_realizad": SIST_INV.get(st.session_state.tto_sistemico, 0),
+                        "grado_histologi": GRADO_INV.get(st.session_state.grado, 1),
+                        "infiltracion_mi": INFIL_INV.get(st.session_state.infiltracion, 1),
+                        "imc": st.session_state.imc if st.session_state.imc else 29.4,
+                        "FIGO2023": FIGO_INV.get(st.session_state.figo, 1),
+                        "recep_est_porcent": st.session_state.recep_est if st.session_state.recep_est else 90.0,
+                        "rece_de_Ppor": st.session_state.recep_prog if st.session_state.recep_prog else 90.0,
+                        "edad": st.session_state.edad if st.session_state.edad else 65,
+                        "tto_1_quirugico": QUIR_INV.get(st.session_state.tto_quirurgico, 1),
+                        "histo_defin": HISTO_INV.get(st.session_state.histo, 2),
+                        "metasta_distan": META_INV.get(st.session_state.metasta, 0),
+                    }
+                    
+                    # Construir la taula comparativa
+                    outcomes = [y_bg[idx] for idx in similar_idx]
+                    
+                    # Valors per variable (columnes: cas actual + similars), arrodonits tots de cop
+                    case_vals = np.column_stack(
+                        [[our_case_original[f] for f in SELECTED_FEATURES]] + [X_bg[idx] for idx in similar_idx]
+                    ).astype(np.float64)
+                    case_ints = np.rint(case_vals).astype(np.int64)
                     
-                    html_table += f'<tr><td class="var-name">{var_name}</td>'
-                    html_table += f'<td class="current-val">{current_val}</td>'
+                    # Crear DataFrame per a la taula
+                    table_data = []
+                    for feat_idx, feat in enumerate(SELECTED_FEATURES):
+                        vals = case_vals[feat_idx].tolist()
+                        ints = case_ints[feat_idx].tolist()
+                        row = {
+                            "Variable": FEATURE_NAMES.get(feat, feat),
+                            "Cas Actual": format_value(feat, vals[0], ints[0]),
+                        }
+                        for i in range(len(similar_idx)):
+                            outcome_emoji = "🟢" if outcomes[i] == 0 else "🔴"
+                            row[f"Similar #{i+1} {outcome_emoji}"] = format_value(feat, vals[i + 1], ints[i + 1])
+                        table_data.append(row)
                     
+                    # Afegir fila de resultat
+                    result_row = {
+                        "Variable": "RESULTAT",
+                        "Cas Actual": f"Predicció: {prob:.1%}",
+                    }
                     for i, idx in enumerate(similar_idx):
-                        case_data = X_bg.iloc[idx]
-                        val = format_value(feat, case_data[feat])
-                        html_table += f'<td>{val}</td>'
+                        outcome = outcomes[i]
+                        outcome_emoji = "🟢" if outcome == 0 else "🔴"
+                        outcome_text = "No Recidiva" if outcome == 0 else "Recidiva"
+                        result_row[f"Similar #{i+1} {outcome_emoji}"] = outcome_text
+                    table_data.append(result_row)
                     
-                    html_table += '</tr>'
-                
-                # Fila de resultat
-                html_table += f'<tr class="result-row"><td class="var-name">RESULTAT</td>'
-                html_table += f'<td class="current-val">Predicció: {prob:.1%}</td>'
-                for i in range(len(similar_idx)):
-                    outcome = outcomes[i]
-                    if outcome == 0:
-                        html_table += '<td class="result-good">No Recidiva</td>'
+                    # Estils de la taula: color del cas actual segons probabilitat
+                    # (st.dataframe només aplica background-color i color del Styler)
+                    if prob < 0.5:
+                        current_style = "background-color: rgba(56, 161, 105, 0.15); color: #276749"
                     else:
-                        html_table += '<td class="result-bad">Recidiva</td>'
-                html_table += '</tr>'
-                
-                html_table += "</tbody></table>"
-                
-                st.markdown(html_table, unsafe_allow_html=True)
+                        current_style = "background-color: rgba(197, 48, 48, 0.15); color: #9b2c2c"
+                    
+                    # Fila de resultat marcada amb fons gris (la cel·la del cas actual manté el seu color)
+                    result_bg = "background-color: rgba(113, 128, 150, 0.2)"
+                    
+                    def result_row_style(row):
+                        if row.name != "RESULTAT":
+                            return [""] * len(row)
+                        return [
+                            "" if col == "Cas Actual"
+                            else f"{result_bg}; color: #38a169" if v == "No Recidiva"
+                            else f"{result_bg}; color: #e53e3e" if v == "Recidiva"
+                            else result_bg
+                            for col, v in row.items()
+                        ]
+                    
+                    df_cmp = pd.DataFrame(table_data).set_index("Variable")
+                    styled_cmp = (
+                        df_cmp.style
+                        .apply(lambda col: [current_style] * len(col), subset=["Cas Actual"])
+                        .apply(result_row_style, axis=1)
+                    )
+                    # Alçada suficient per mostrar totes les files sense scroll
+                    st.dataframe(styled_cmp, use_container_width=True, height=(len(df_cmp) + 1) * 35 + 3)
                     
             else:
                 st.warning("No s'han trobat dades històriques per comparar.")
@@ -1230,36 +1240,23 @@ with tab2:
         
         if st.session_state.input_data is not None:
             try:
-                # Recollir valors originals del formulari
-                original_values = {
-                    "edad": st.session_state.get("edad"),
-                    "imc": st.session_state.get("imc"),
-                    "grupo_riesgo": st.session_state.get("grupo_riesgo"),
-                    "estadiaje_pre": st.session_state.get("estadiaje_pre"),
-                    "histo": st.session_state.get("histo"),
-                    "grado": st.session_state.get("grado"),
-                    "infiltracion": st.session_state.get("infiltracion"),
-                    "figo": st.session_state.get("figo"),
-                    "metasta": st.session_state.get("metasta"),
-                    "tto_quirurgico": st.session_state.get("tto_quirurgico"),
-                    "tto_sistemico": st.session_state.get("tto_sistemico"),
-                    "afect_linf": st.session_state.get("afect_linf"),
-                    "recep_est": st.session_state.get("recep_est"),
-                    "recep_prog": st.session_state.get("recep_prog"),
-                }
+                # Recollir valors originals del formulari (mateix ordre que PDF_KEYS)
+                original_values = tuple(st.session_state.get(k) for k in PDF_KEYS)
                 
+                # Minut actual: mateixa data dins l'informe i al nom del fitxer
+                generated_at = datetime.now().replace(second=0, microsecond=0)
                 pdf_bytes = generate_pdf_report(
                     prob=st.session_state.prob,
-                    risk_level=risk_level,
                     original_values=original_values,
                     shap_values=st.session_state.shap_values,
-                    features=SELECTED_FEATURES
+                    features=SELECTED_FEATURES,
+                    generated_at=generated_at
                 )
                 
                 st.download_button(
                     label="⬇️ Descarregar Informe PDF",
                     data=pdf_bytes,
-                    file_name=f"NEST_informe_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf",
+                    file_name=f"NEST_informe_{generated_at.strftime('%Y%m%d_%H%M')}.pdf",
                     mime="application/pdf",
                     use_container_width=True,
                     type="primary"
@@ -1271,6 +1268,7 @@ with tab2:
 # --- TAB 3: ANÀLISI AVANÇADA (PCA) ---
 with tab3:
     st.header("Anàlisi Avançada i Segmentació (PCA)")
+    available_images = list_images(str(IMAGES_DIR))
     
     st.markdown("S'han buscat diferents conjunts de variables per agrupar individus en funció de la seva similitud. És a dir, si dues persones tenen valors similars en la majoria de les variables s'han afegit al mateix grup. Hem buscat separar tots els individus del tipus NSMP en dos grups en funció del risc de recaiguda.")
 
@@ -1278,20 +1276,10 @@ with tab3:
     st.subheader("1. Distribució de Risc per Clúster")
     col1, col2 = st.columns(2)
     
-    IMAGES_DIR = BASE_DIR / "images"
-    
     with col1:
-        stack_bar_path = IMAGES_DIR / "stack_bar.png"
-        if stack_bar_path.exists():
-            st.image(str(stack_bar_path), width='stretch')
-        else:
-            st.warning("⏳ Imatge `stack_bar.png` pendent de pujar")
+        show_image("stack_bar.png", available_images)
     with col2:
-        group_bar_path = IMAGES_DIR / "group_bar.png"
-        if group_bar_path.exists():
-            st.image(str(group_bar_path), width='stretch')
-        else:
-            st.warning("⏳ Imatge `group_bar.png` pendent de pujar")
+        show_image("group_bar.png", available_images)
     
     st.markdown("A l'esquerra es pot veure la proporció d'individus que han tingut una recaiguda en cada grup. Com es pot veure, hem aconseguit separar individus que poden ser considerats de baix risc, ja que tan sols el 5% d'ells patirà una recaiguda, dels que es poden considerar d'alt risc, on la proporció dels que recauen és de més del 65%.")
     st.markdown("A la dreta es pot veure la quantitat d'individus que han recaigut o no en cada grup. Com es pot observar, més de 100 individus no recauen en el grup de baix risc, mentre que tan sols 6 sís. Pel que fa al grup d'alt risc gairebé 30 dones han tingut recaiguda, mentre que 15 no.")
@@ -1300,11 +1288,7 @@ with tab3:
 
     # 2. K-Means vs Original
     st.subheader("2. Validació: K-Means vs Realitat Clínica")
-    kmeans_path = IMAGES_DIR / "k_means_vs_og.png"
-    if kmeans_path.exists():
-        st.image(str(kmeans_path), width='stretch')
-    else:
-        st.warning("⏳ Imatge `k_means_vs_og.png` pendent de pujar")
+    show_image("k_means_vs_og.png", available_images)
     
     st.markdown("Hem aplicat PCA per representar els grups en dues dimensions per veure com es diferencien. A l'esquerra hi ha la nostra agrupació, mentre que a la dreta hi ha els grups als quals pertanyen en realitat, en funció de si hi ha hagut recaiguda o no. Clarament és molt similar.")
     st.markdown("Per fer aquest clustering hem fet servir variables ja estudiades i que se sap com influeixen sobre el risc de la pacient. Tot i així, utilitzant-les totes s'ha pogut trobar una clara diferenciació entre dos subgrups dins dels individus del tipus NSMP, on unes tenen risc molt més elevat que les altres i probablement s'hauran de tractar de forma més agressiva o menys.")
@@ -1316,17 +1300,9 @@ with tab3:
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("**Variables Originals**")
-        biplot_path = IMAGES_DIR / "biplot.png"
-        if biplot_path.exists():
-            st.image(str(biplot_path), width='stretch')
-        else:
-            st.warning("⏳ Imatge `biplot.png` pendent de pujar")
+        show_image("biplot.png", available_images)
     with col2:
         st.markdown("**Variables Seleccionades**")
-        pca_nuevo_path = IMAGES_DIR / "pca_nuevo.png"
-        if pca_nuevo_path.exists():
-            st.image(str(pca_nuevo_path), width='stretch')
-        else:
-            st.warning("⏳ Imatge `pca_nuevo.png` pendent de pujar")
+        show_image("pca_nuevo.png", available_images)
     
     st.markdown("En aquests gràfics es pot veure una anàlisi de l’explicabilitat d’algunes variables molt útils per a la separació de pacients en funció del seu risc. A l’esquerra s’han utilitzat les variables més típicament usades, mentre que a la dreta s’han emprat aquelles que no s’utilitzen tan sovint per veure si aporten informació per fer aquesta classificació. Tal com es pot veure, sí que és el cas, i es pot obtenir una separació molt similar. Es pot veure que n_total_GC , abordajeqx i histe_avanz més gran fan que el risc de la pacient sigui considerat com a menor, mentre que si el valor de AP_ganPelv, n_gangP_afec, tx_anexial i AP_glanPaor és alt, el risc probablement també ho serà. De les totes variables no tan utilitzades, les que apareixen en aquest gràfic de la dreta han resultat les més útils per classificar les pacients en funció del seu risc.")